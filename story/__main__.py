@@ -1,4 +1,4 @@
-from story.utils import text_to_speech, parse_story, combine_mp4s, Worker
+from story.utils import text_to_speech, parse_story, combine_mp4s, Worker, Scheduler, plan_story, parse_range
 import argparse
 import torch
 import torchaudio
@@ -21,6 +21,8 @@ def main():
     parser.add_argument('--output_path', type=str, help='path to output folder', default="results/")
     parser.add_argument('--output_name', type=str, help='name of output file', default="story")
     parser.add_argument('--preset', type=str, help='Which voice preset to use.', default='high_quality')  # "ultra_fast", "fast", "standard", "high_quality"
+    parser.add_argument('--only', type=str, help='range of lines to finish first, e.g. 10-40', default=None)
+    parser.add_argument('--max_jobs', type=int, help='max number of jobs running on the compute server at once', default=4)
   
     args = parser.parse_args()
     all_workers = []
@@ -39,11 +41,14 @@ def main():
     logging.info("Starting story generation.")
 
     logging.info(f"Story has {len(the_story)} parts.")
+    # lines in --only first, then earliest deadline, server jobs share one priority queue
+    scheduler = Scheduler(max_jobs=args.max_jobs)
+    the_plan = plan_story(the_story, only=parse_range(args.only))
     try:
-        for index, voice, sentiment, text in the_story:
+        for index, voice, sentiment, text, priority in the_plan:
             logging.info(f"Dialog {index}/{len(the_story)} time passed: {int(time.time() - start)//60} min {int(time.time() - start)%60} seconds.")
-            worker = Worker(index, voice, sentiment, text, preset=args.preset, output_path=args.output_path)
-            worker()
+            worker = Worker(index, voice, sentiment, text, preset=args.preset, output_path=args.output_path, priority=priority)
+            worker(scheduler=scheduler)
             all_workers.append(worker)
             time.sleep(1)
     except KeyboardInterrupt:
@@ -52,9 +57,11 @@ def main():
             w.join()
         logging.info("All workers joined.")
     print("Fetching all from compute server ...")
+    all_workers.sort(key=lambda w: w.index)
     for w in tqdm.tqdm(all_workers):
         # w.join()
         w.save_mp4()
+    scheduler.close()
 
     #combine all mp4s
     print("Combining all mp4s...")
@@ -14,6 +14,8 @@ import threading
 import logging
 import random
 import zipfile
+import heapq
+import itertools
 
 from tortoise.api import TextToSpeech, MODELS_DIR
 from tortoise.utils.audio import load_voices, load_audio
@@ -277,10 +279,91 @@ def combine_mp4s(mp4s, output_path, output_name="story"):
         clip.close()
     return path
 
+# rough relative server cost of each stage per second of audio
+stage_cost = {
+    "bvh": 1.0,
+    "mp4": 1.0,
+    "fbx": 0.2,
+}
+
+def parse_range(text):
+    # "10-40" -> range(10, 41), "10" -> range(10, 11)
+    if text is None:
+        return None
+    if '-' in text:
+        start, end = text.split('-')
+    else:
+        start, end = text, text
+    return range(int(start), int(end) + 1)
+
+def estimate_duration(text, words_per_second=2.5):
+    # spoken length of a line before tts has run
+    return max(len(text.split()) / words_per_second, 1.0)
+
+def plan_story(timeline, only=None):
+    # order the story so lines in `only` are generated first, then the rest in story order.
+    # each line gets a deadline: the estimated playback time at which a viewer reaches it.
+    tiers = [[], []]
+    for line in timeline:
+        index = line[0]
+        tier = 0 if only is None or index in only else 1
+        tiers[tier].append(line)
+    plan = []
+    for tier, lines in enumerate(tiers):
+        deadline = 0.0
+        for index, voice, sentiment, text in lines:
+            plan.append((index, voice, sentiment, text, (tier, deadline)))
+            deadline += estimate_duration(text)
+    return plan
+
+
+class Scheduler:
+    # runs server jobs from one priority queue shared by the whole story,
+    # with at most `max_jobs` jobs in flight on the compute server.
+    def __init__(self, max_jobs=4, logger=None):
+        self.queue = []
+        self.counter = itertools.count()
+        self.cond = threading.Condition()
+        self.closed = False
+        if logger is None:
+            self.logger = logging
+        else:
+            self.logger = logger
+        self.threads = [threading.Thread(target=self._run, daemon=True) for _ in range(max_jobs)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, priority, fn, *args):
+        # lower priority tuples run first, ties run in submission order
+        with self.cond:
+            heapq.heappush(self.queue, (priority, next(self.counter), fn, args))
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.queue and not self.closed:
+                    self.cond.wait()
+                if not self.queue:
+                    return
+                _, _, fn, args = heapq.heappop(self.queue)
+            try:
+                fn(*args)
+            except Exception as e:
+                self.logger.error(f"scheduled job failed - {e}")
+
+    def close(self):
+        # finish everything queued, then stop the threads
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
 
 
 class Worker:
-    def __init__(self, index, voice, sentiment, text, output_path,logger=None, **kvargs):
+    def __init__(self, index, voice, sentiment, text, output_path,logger=None, priority=(0, 0.0), **kvargs):
         self.index = index
         self.voice = voice
         self.sentiment = sentiment
@@ -296,6 +379,11 @@ class Worker:
         self.state = "NOT_STARTED"
         self.error = None
         self.worker = None
+        self.scheduler = None
+        self.priority = priority
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.done = threading.Event()
         self.output_path = output_path
         self.kvargs = kvargs
         if logger is None:
@@ -334,11 +422,77 @@ class Worker:
             raise e
 
 
-    def __call__(self, device="cuda:0") -> Any:
+    def job_priority(self, stage):
+        # least slack first: deadline minus estimated server time, so long lines start earlier
+        tier, deadline = self.priority
+        cost = stage_cost[stage] * self.wav.shape[-1] / 24000
+        return (tier, deadline - cost)
+
+    def schedule(self, scheduler, wav):
+        # bvh goes on the shared queue, fbx and mp4 are queued as soon as it is done
+        self.state = "RUNNING"
+        self.scheduler = scheduler
+        self.pending = 2
+        scheduler.submit(self.job_priority("bvh"), self.bvh_job, wav)
+
+    def bvh_job(self, wav):
+        try:
+            bvh_id = dispatch_generate_bvh(wav, style=self.sentiment)
+            self.logger.info(f"index {self.index} - bvh_id {bvh_id}")
+            self.bvh = wait_and_get(bvh_id)
+            self.logger.info(f"index {self.index} - bvh done")
+        except Exception as e:
+            self.pending = 1
+            self.stage_done(e)
+            raise e
+        self.scheduler.submit(self.job_priority("mp4"), self.mp4_job, wav)
+        self.scheduler.submit(self.job_priority("fbx"), self.fbx_job)
+
+    def mp4_job(self, wav):
+        try:
+            mp4_id = dispatch_generate_mp4(self.bvh, wav)
+            self.logger.info(f"index {self.index} - mp4_id {mp4_id}")
+            self.mp4 = wait_and_get(mp4_id)
+            self.logger.info(f"index {self.index} - mp4 done")
+            self.save_mp4(sync=False)
+        except Exception as e:
+            self.stage_done(e)
+            raise e
+        self.stage_done()
+
+    def fbx_job(self):
+        try:
+            fbx_id = dispatch_generate_fbx(self.bvh)
+            self.logger.info(f"index {self.index} - fbx_id {fbx_id}")
+            self.fbx = wait_and_get(fbx_id)
+            self.logger.info(f"index {self.index} - fbx done")
+            self.save_fbx(sync=False)
+        except Exception as e:
+            self.stage_done(e)
+            raise e
+        self.stage_done()
+
+    def stage_done(self, error=None):
+        with self.lock:
+            if error is not None:
+                self.state = "FAILURE"
+                self.error = error
+            self.pending -= 1
+            if self.pending > 0:
+                return
+            if self.state != "FAILURE":
+                self.logger.info(f"index {self.index} - done")
+                self.state = "SUCCESS"
+        self.done.set()
+
+    def __call__(self, device="cuda:0", scheduler=None) -> Any:
         try:
             self.logger.info(f"index {self.index} - tts")
             self.wav, wav_path = text_to_speech(self.text, self.voice, index=self.index, device=device, output_path=self.output_path, **self.kvargs)
             self.logger.info(f"index {self.index} - wav done")
+            if scheduler is not None:
+                self.schedule(scheduler, wav_path)
+                return
             # self.dispatch(wav_path)
             # do dispatch to server in a thread
             self.worker = threading.Thread(target=self.dispatch, args=(wav_path,))
@@ -350,6 +504,8 @@ class Worker:
             raise e
         
     def join(self):
+        if self.scheduler is not None:
+            self.done.wait()
         if self.worker is not None:
             try:
                 self.worker.join()